@@ -1,9 +1,13 @@
 import datetime
+import fnmatch
+import json
 import logging
 import os
 import re
 import shlex
 import subprocess
+import tempfile
+import threading
 import time
 
 from funcs import check_host
@@ -26,7 +30,17 @@ class BBackup:
             borg_stats=True,
             borg_archive_name_template="%Y-%m-%d_%H-%M-%S",
             borg_rsh='ssh',
-            borg_args=()
+            borg_args=(),
+            state_file=None,
+            schedule_mode='interval',
+            due_window=0,
+            borg_checkpoint_interval=0,
+            resume_max_attempts=5,
+            verify_interval=0,
+            verify_max_duration=600,
+            verify_period=0,
+            verify_archives_interval=0,
+            stdin_sources=()
     ):
         self.name = name
         self.timestamp_file = timestamp_file
@@ -43,7 +57,22 @@ class BBackup:
         self.borg_stats = borg_stats
         self.restrict_to_environments = restrict_to_environments
         self.allowed_environments = allowed_environments
+        self.state_file = state_file if state_file else timestamp_file + '.state'
+        self.schedule_mode = schedule_mode
+        self.due_window = due_window
+        self.borg_checkpoint_interval = borg_checkpoint_interval
+        self.resume_max_attempts = resume_max_attempts
+        self.verify_interval = verify_interval
+        self.verify_max_duration = verify_max_duration
+        self.verify_period = verify_period
+        self.verify_archives_interval = verify_archives_interval
+        self.stdin_sources = stdin_sources
         self.list = None
+        self.proc = None
+        self.producer = None
+        self.cancelled = False
+        # Protects cancelled together with proc and producer, so a cancel cannot slip in before they are started
+        self.proc_lock = threading.Lock()
 
     def connect_check(self):
         return check_host(self.host)
@@ -57,92 +86,472 @@ class BBackup:
         else:
             return True
 
-    def run(self):
+    def get_env(self):
         env = os.environ.copy()
         env['BORG_REPO'] = self.borg_repo
         env['BORG_RSH'] = self.borg_rsh
         env['BORG_PASSPHRASE'] = self.borg_passphrase
+        return env
 
-        now = time.time()
-
-        archive_name = ('::{:%s}' % (self.borg_archive_name_template,)).format(datetime.datetime.fromtimestamp(now))
-        params = ['borg', 'create'] + (['--stats'] if self.borg_stats else []) + [archive_name] + self.borg_args
-        params += self.backup_directories
-
-        tokens = [shlex.quote(token) for token in params]
-        logging.info('Running \'%s\'', ' '.join(tokens))
-
-        p = subprocess.Popen(
-            params,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env
-        )
-        stdout, stderr = p.communicate()
-        stdout_ = stdout.decode()
-        stderr_ = stderr.decode()
-        if stdout_ or stderr_:
-            logging.info('BORG create output:\n' + stdout_ + stderr_)
-        if p.returncode == 0:
-            params = ['borg', 'prune'] + (['--stats'] if self.borg_stats else []) + self.borg_prune_args
+    def run_borg(self, params, env):
+        # Run a borg command, log its output and return its exit code and output
+        # Returns None as exit code if the command was cancelled before it could be started
+        with self.proc_lock:
+            if self.cancelled:
+                logging.info('Not running \'%s\', cancelled by user.', ' '.join(params[:2]))
+                return None, ''
 
             tokens = [shlex.quote(token) for token in params]
             logging.info('Running \'%s\'', ' '.join(tokens))
 
-            p = subprocess.Popen(
+            self.proc = subprocess.Popen(
                 params,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 env=env
             )
-            stdout, stderr = p.communicate()
-            stdout_ = stdout.decode()
-            stderr_ = stderr.decode()
-            if stdout_ or stderr_:
-                logging.info('BORG prune output:\n' + stdout_ + stderr_)
+        stdout, stderr = self.proc.communicate()
+        output = stdout.decode() + stderr.decode()
+        if output:
+            logging.info('BORG %s output:\n' % params[1] + output)
+        returncode = self.proc.returncode
+        self.proc = None
+        return returncode, output
+
+    def cancel(self):
+        # Called from main thread, stops the currently running borg command of this bbackup
+        with self.proc_lock:
+            self.cancelled = True
+            proc = self.proc
+            if proc is not None and proc.poll() is None:
+                logging.warning('Terminating borg process of \'%s\'.', self.name)
+                proc.terminate()
+            producer = self.producer
+            if producer is not None and producer.poll() is None:
+                logging.warning('Terminating stdin source of \'%s\'.', self.name)
+                producer.terminate()
+
+    def create_params(self):
+        params = ['borg', 'create'] + (['--stats'] if self.borg_stats else [])
+        if self.borg_checkpoint_interval > 0:
+            params += ['--checkpoint-interval', str(self.borg_checkpoint_interval)]
+        return params
+
+    def run_stdin_source(self, stdin_name, command, archive_name, env):
+        # Pipe the output of command directly into borg create, without a temporary file
+        # Returns exit codes of borg and command, None if it could not be started
+        params = self.create_params() + ['--stdin-name', stdin_name, archive_name] + self.borg_args + ['-']
+
+        with tempfile.TemporaryFile() as producer_stderr:
+            with self.proc_lock:
+                if self.cancelled:
+                    logging.info('Not running stdin source \'%s\', cancelled by user.', stdin_name)
+                    return None, None
+
+                logging.info('Running \'%s | %s\'', ' '.join(shlex.quote(token) for token in command),
+                             ' '.join(shlex.quote(token) for token in params))
+
+                # The producer does not get the borg environment, it has no business knowing the passphrase
+                try:
+                    self.producer = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=producer_stderr)
+                except OSError as e:
+                    logging.error('Could not start stdin source \'%s\': %s', stdin_name, str(e))
+                    return None, None
+                self.proc = subprocess.Popen(
+                    params,
+                    stdin=self.producer.stdout,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    env=env
+                )
+            # borg is the only reader now, if it exits early the producer gets SIGPIPE instead of blocking
+            self.producer.stdout.close()
+            stdout, stderr = self.proc.communicate()
+            producer_returncode = self.producer.wait()
+            producer_stderr.seek(0)
+            producer_output = producer_stderr.read().decode(errors='replace')
+
+        output = stdout.decode() + stderr.decode()
+        if output:
+            logging.info('BORG create output:\n' + output)
+        if producer_output:
+            logging.info('Stdin source \'%s\' output:\n' % (stdin_name,) + producer_output)
+        returncode = self.proc.returncode
+        self.proc = None
+        self.producer = None
+        return returncode, producer_returncode
+
+    def run(self):
+        env = self.get_env()
+
+        now = time.time()
+        start = time.monotonic()
+
+        archive_name = ('::{:%s}' % (self.borg_archive_name_template,)).format(datetime.datetime.fromtimestamp(now))
+
+        returncode = 0
+        last_archive_name = None
+        if self.backup_directories:
+            params = self.create_params() + [archive_name] + self.borg_args
+            params += self.backup_directories
+            last_archive_name = archive_name
+            returncode, _ = self.run_borg(params, env)
+
+        # Every stdin source is stored in an archive of its own, one after another
+        for stdin_name, command in self.stdin_sources:
+            if returncode != 0:
+                break
+            stdin_archive_name = '::' + self.stdin_series(stdin_name) + '-' + archive_name[2:]
+            last_archive_name = stdin_archive_name
+            returncode, producer_returncode = self.run_stdin_source(stdin_name, command, stdin_archive_name, env)
+            if returncode == 0 and producer_returncode != 0:
+                # borg archived whatever the producer wrote before failing, don't keep an incomplete dump
+                logging.error('Stdin source \'%s\' of \'%s\' failed with exit status %d, deleting archive.',
+                              stdin_name, self.name, producer_returncode)
+                self.run_borg(['borg', 'delete', stdin_archive_name], env)
+                return False
+
+        if returncode == 0:
+            # Only a completed archive counts as a backup, prune also removes checkpoint archives now
+            # Every archive series is pruned on its own, so the series don't compete for the same slots
+            params = ['borg', 'prune'] + (['--stats'] if self.borg_stats else [])
+            if self.backup_directories:
+                self.run_borg(params + self.borg_prune_args, env)
+            prune_args, _ = self.split_archive_filter(self.borg_prune_args)
+            for stdin_name, _ in self.stdin_sources:
+                self.run_borg(params + prune_args + ['--glob-archives', self.stdin_series(stdin_name) + '-*'], env)
             self.store_timestamp(now)
+            self.store_duration(time.monotonic() - start)
+            self.store_resume(None)
+            self.store_resume_given_up(False)
             return True
+        elif returncode is not None and not self.cancelled:
+            self.detect_interruption(returncode, last_archive_name, env)
+            return False
         else:
             return False
 
+    def list_checkpoints(self, archive_name, env):
+        # Checkpoint archives borg left for the given archive, None if the repository cannot be listed
+        # borg names them '<archive>.checkpoint', or '<archive>.checkpoint.N' for further ones
+        name = archive_name[2:]
+        params = ['borg', 'list', '--short', '--glob-archives', name + '.checkpoint*']
+        returncode, output = self.run_borg(params, env)
+        if returncode != 0:
+            return None
+        pattern = re.escape(name) + r'\.checkpoint(\.\d+)?'
+        return [line for line in output.splitlines() if re.fullmatch(pattern, line)]
+
+    def detect_interruption(self, returncode, archive_name, env):
+        # borg create failed, find out if it left checkpoint archives that the next run can resume from
+        if returncode == 1:
+            # Only warnings, nothing was interrupted
+            interrupted = False
+            checkpoints = []
+        else:
+            checkpoints = self.list_checkpoints(archive_name, env)
+            if checkpoints is None:
+                # Repository cannot be listed, it was interrupted if the connection to the host dropped
+                interrupted = not self.connect_check()
+            else:
+                interrupted = bool(checkpoints)
+
+        if not interrupted:
+            self.store_resume(None)
+            return
+
+        state = self.load_state()
+        if state.get('resume_given_up'):
+            # Resuming failed too often, stay on the normal schedule until the next successful backup
+            return
+
+        resume = state.get('resume', {})
+        attempts = resume.get('attempts', 0) + 1
+        if attempts > self.resume_max_attempts:
+            logging.error('Backup \'%s\' was interrupted %d times in a row, giving up resuming it until the next '
+                          'successful backup.', self.name, attempts)
+            del state['resume']
+            state['resume_given_up'] = True
+            self.save_state(state)
+            return
+
+        logging.warning('Backup \'%s\' was interrupted (exit status %d, checkpoints: %s), resuming as soon as '
+                        'possible.', self.name, returncode, str(checkpoints))
+        self.store_resume({
+            'since': resume.get('since', int(time.time())),
+            'attempts': attempts,
+            'returncode': returncode,
+            'checkpoints': checkpoints
+        })
+
+    def store_resume(self, resume):
+        state = self.load_state()
+        if resume is None:
+            if 'resume' not in state:
+                return
+            del state['resume']
+        else:
+            state['resume'] = resume
+        self.save_state(state)
+
+    def store_resume_given_up(self, given_up):
+        state = self.load_state()
+        if state.get('resume_given_up', False) != given_up:
+            state['resume_given_up'] = given_up
+            self.save_state(state)
+
+    def resume_pending(self):
+        return 'resume' in self.load_state()
+
+    def resume_attempts(self):
+        return self.load_state().get('resume', {}).get('attempts', 0)
+
     def run_list(self):
-        env = os.environ.copy()
-        env['BORG_REPO'] = self.borg_repo
-        env['BORG_RSH'] = self.borg_rsh
-        env['BORG_PASSPHRASE'] = self.borg_passphrase
+        env = self.get_env()
 
         params = ['borg', 'list'] + self.borg_list_args
 
-        tokens = [shlex.quote(token) for token in params]
-        logging.info('Running \'%s\'', ' '.join(tokens))
-
-        p = subprocess.Popen(
-            params,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env
-        )
-        stdout, stderr = p.communicate()
-        stdout_ = stdout.decode()
-        stderr_ = stderr.decode()
-        if stdout_ or stderr_:
-            logging.info('BORG list output:\n' + stdout_ + stderr_)
-        self.list = stdout_ + stderr_
-        return p.returncode == 0
-
-    def check(self):
+        returncode, output = self.run_borg(params, env)
+        self.list = output
+        return returncode == 0
+
+    def run_verify(self, kind):
+        # Verify one slice of the repository segments or all archives, kind is 'repository' or 'archives'
+        env = self.get_env()
+        now = time.time()
+        state = self.load_state()
+        verify = state.get('verify', {})
+
+        if kind == 'repository':
+            # borg remembers the last checked segment and continues from there on the next partial check
+            params = ['borg', 'check', '--info', '--repository-only', '--max-duration', str(self.verify_max_duration)]
+            if verify.get('pass_start') is None:
+                verify['pass_start'] = int(now)
+                verify['pass_slices'] = 0
+        else:
+            params = ['borg', 'check', '--info', '--archives-only']
+
+        returncode, output = self.run_borg(params, env)
+        if returncode is None:
+            return False
+        result = {0: 'ok', 1: 'warning'}.get(returncode, 'error')
+
+        # Reload state, it may have been changed while borg check was running
+        state = self.load_state()
+        if kind == 'repository':
+            verify['last_slice'] = int(now)
+            verify['last_result'] = result
+            verify['pass_slices'] = verify.get('pass_slices', 0) + 1
+            # borg logs 'finished partial segment check, last segment checked is N' or, once it reached the end,
+            # 'finished segment check at segment N', the case differs between borg versions
+            partial = re.search(r'finished partial segment check, last segment checked is (-?\d+)', output, re.I)
+            if returncode == 0 and partial:
+                verify['last_segment'] = int(partial.group(1))
+            elif returncode == 0:
+                # Reached the last segment, the whole repository has been verified
+                complete = re.search(r'finished segment check at segment (\d+)', output, re.I)
+                if complete:
+                    verify['segments'] = int(complete.group(1))
+                logging.info('Verified all segments of \'%s\' in %d slice(s).', self.name, verify['pass_slices'])
+                verify['last_complete'] = int(now)
+                verify['pass_start'] = None
+                verify['last_segment'] = None
+        else:
+            verify['last_archives'] = int(now)
+            verify['last_archives_result'] = result
+        state['verify'] = verify
+        self.save_state(state)
+
+        if returncode != 0:
+            logging.error('Verification (%s) of \'%s\' reported problems, exit status %d.', kind, self.name,
+                          returncode)
+        return returncode == 0
+
+    def verify_coverage(self, verify):
+        # Fraction of segments verified in the current pass, None if unknown
+        if verify.get('pass_start') is None:
+            return 0.0
+        if verify.get('last_segment') is None or not verify.get('segments'):
+            return None
+        return min(verify['last_segment'] / verify['segments'], 1.0)
+
+    def verify_due(self):
+        # Returns which verification is due ('repository' or 'archives') or None
+        if self.verify_interval <= 0 and self.verify_archives_interval <= 0:
+            return None
+        state = self.load_state()
+        verify = state.get('verify', {})
+        now = time.time()
+
+        if self.verify_archives_interval > 0 and verify.get('last_archives') is None and 'archives_since' not in verify:
+            # The archives check is not time-boxed, do not hold the repository lock for it right away
+            # but only once the interval has passed since it was enabled
+            verify['archives_since'] = int(now)
+            state['verify'] = verify
+            self.save_state(state)
+
+        # Time-boxed slices of the repository check are preferred over the full archives check
+        if self.verify_interval > 0:
+            if now - verify.get('last_slice', 0) > self.verify_interval:
+                return 'repository'
+
+            # Run slices more often if the current pass would not finish within verify_period
+            if self.verify_period > 0 and verify.get('pass_start') is not None:
+                elapsed = (now - verify['pass_start']) / self.verify_period
+                coverage = self.verify_coverage(verify)
+                if elapsed >= 1 or (coverage is not None and elapsed > coverage):
+                    logging.info('Verification of \'%s\' is behind schedule (%.0f%% of period elapsed, coverage '
+                                 '%s).', self.name, 100 * elapsed,
+                                 'unknown' if coverage is None else '%.0f%%' % (100 * coverage,))
+                    return 'repository'
+
+        last_archives = verify.get('last_archives') or verify.get('archives_since', 0)
+        if self.verify_archives_interval > 0 and now - last_archives > self.verify_archives_interval:
+            return 'archives'
+        return None
+
+    def verify_status(self):
+        verify = self.load_state().get('verify', {})
+        return {
+            'coverage': self.verify_coverage(verify),
+            'last_slice': verify.get('last_slice'),
+            'last_result': verify.get('last_result'),
+            'last_complete': verify.get('last_complete'),
+            'last_archives': verify.get('last_archives'),
+            'last_archives_result': verify.get('last_archives_result')
+        }
+
+    def get_timestamp(self):
         try:
             with open(self.timestamp_file, 'r') as f:
-                backup_ts = int(f.read())
-                now_ts = time.time()
-                return (now_ts - backup_ts) > self.interval
+                return int(f.read())
         except FileNotFoundError:
+            return None
+
+    def check(self, idle_profile=None, check_interval=0):
+        if self.resume_pending():
+            # An interrupted run is resumed right away, regardless of schedule
+            return True
+
+        backup_ts = self.get_timestamp()
+        if backup_ts is None:
+            return True
+        now = time.time()
+        due = backup_ts + self.interval
+
+        if self.schedule_mode != 'idle' or idle_profile is None or self.due_window <= 0:
+            return now > due
+
+        # Start anywhere in the due window around the nominal time, preferring quiet periods
+        if now < due - self.due_window / 2:
+            return False
+        if self.latest_start_reached(check_interval):
+            # The next check would be too late, start now regardless of load
             return True
+        return idle_profile.is_good_start(now, due + self.due_window / 2, self.expected_duration())
+
+    def latest_start_reached(self, check_interval):
+        # True if an idle scheduled bbackup has to be started now, the next check would be after its due window
+        backup_ts = self.get_timestamp()
+        if self.schedule_mode != 'idle' or self.due_window <= 0 or backup_ts is None:
+            return False
+        return time.time() + check_interval >= backup_ts + self.interval + self.due_window / 2
+
+    def load_state(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.warning('State file \'%s\' of \'%s\' is corrupt, ignoring it.', self.state_file, self.name)
+            return {}
+
+    def save_state(self, state):
+        with open(self.state_file, 'w') as f:
+            json.dump(state, f)
+
+    def store_duration(self, duration):
+        # Keep durations of the last successful runs
+        state = self.load_state()
+        state['durations'] = (state.get('durations', []) + [int(duration)])[-10:]
+        self.save_state(state)
+
+    def expected_duration(self):
+        # Median duration of the last successful runs, 0 if unknown
+        durations = sorted(self.load_state().get('durations', []))
+        if not durations:
+            return 0
+        return durations[len(durations) // 2]
 
     def store_timestamp(self, timestamp):
         with open(self.timestamp_file, 'w') as f:
             f.write(str(int(timestamp)))
 
+    @staticmethod
+    def stdin_series(stdin_name):
+        # Prefix of the archives of a stdin source
+        return stdin_name.replace('/', '_')
+
+    @staticmethod
+    def split_archive_filter(args):
+        # Separate the options selecting archives (--glob-archives, --prefix) from other borg arguments
+        # Returns the remaining arguments and the selecting glob pattern, None if there is none
+        rest = []
+        glob = None
+        i = 0
+        while i < len(args):
+            opt, sep, value = args[i].partition('=')
+            if opt in ('--glob-archives', '-a', '--prefix', '-P'):
+                if not sep:
+                    i += 1
+                    value = args[i] if i < len(args) else ''
+                glob = value + '*' if opt in ('--prefix', '-P') else value
+            else:
+                rest.append(args[i])
+            i += 1
+        return rest, glob
+
+    def check_archive_series(self):
+        # Archives of backup_directories and of every stdin source form separate series, pruned one by one
+        # Raises ValueError if pruning one series could delete archives of another one
+        if not self.stdin_sources:
+            return
+        sample = '{:%s}' % (self.borg_archive_name_template,)
+        sample = sample.format(datetime.datetime.now())
+        series = [self.stdin_series(stdin_name) for stdin_name, _ in self.stdin_sources]
+        samples = [name + '-' + sample for name in series]
+
+        for name in series:
+            if len([s for s in samples if s.startswith(name + '-')]) > 1:
+                raise ValueError('backup \'%s\': archives of stdin source \'%s\' cannot be told apart from those of '
+                                 'another stdin source' % (self.name, name))
+
+        if self.backup_directories:
+            if any(sample.startswith(name + '-') for name in series):
+                raise ValueError('backup \'%s\': archives of backup_directories cannot be told apart from those of '
+                                 'stdin_sources' % (self.name,))
+            _, glob = self.split_archive_filter(self.borg_prune_args)
+            if glob is None:
+                raise ValueError('backup \'%s\' uses stdin_sources, borg_prune_args needs --glob-archives or '
+                                 '--prefix matching only the archives of backup_directories' % (self.name,))
+            if not fnmatch.fnmatchcase(sample, glob) or any(fnmatch.fnmatchcase(s, glob) for s in samples):
+                raise ValueError('backup \'%s\': archive filter \'%s\' in borg_prune_args must match the archives '
+                                 'of backup_directories and none of stdin_sources' % (self.name, glob))
+
+    @staticmethod
+    def parse_stdin_sources(value):
+        # One stdin source per line: stdin name followed by the command producing the data
+        sources = []
+        for line in value.splitlines():
+            tokens = shlex.split(line)
+            if not tokens:
+                continue
+            if len(tokens) < 2:
+                raise ValueError('stdin source \'%s\' has no command' % (tokens[0],))
+            sources.append((tokens[0], tokens[1:]))
+        return sources
+
     @staticmethod
     def from_config(cnf):
         bbackups = []
@@ -158,12 +567,25 @@ class BBackup:
                     borg_rsh=cnf.get(s, 'borg_rsh', fallback='ssh'),
                     borg_archive_name_template=cnf.get(s, 'borg_archive_name_template', fallback='%Y-%m-%d_%H-%M-%S'),
                     borg_passphrase=cnf.get(s, 'borg_passphrase'),
-                    backup_directories=shlex.split(cnf.get(s, 'backup_directories')),
+                    backup_directories=shlex.split(cnf.get(s, 'backup_directories', fallback='')),
+                    stdin_sources=BBackup.parse_stdin_sources(cnf.get(s, 'stdin_sources', fallback='')),
                     borg_prune_args=shlex.split(cnf.get(s, 'borg_prune_args')),
                     borg_args=shlex.split(cnf.get(s, 'borg_args', fallback='')),
                     borg_stats=cnf.getboolean(s, 'borg_stats', fallback=True),
                     borg_list_args=shlex.split(cnf.get(s, 'borg_list_args', fallback='')),
+                    state_file=cnf.get(s, 'state_file', fallback=None),
+                    schedule_mode=cnf.get(s, 'schedule_mode', fallback='interval').lower(),
+                    due_window=cnf.getint(s, 'due_window', fallback=0),
+                    borg_checkpoint_interval=cnf.getint(s, 'borg_checkpoint_interval', fallback=0),
+                    resume_max_attempts=cnf.getint(s, 'resume_max_attempts', fallback=5),
+                    verify_interval=cnf.getint(s, 'verify_interval', fallback=0),
+                    verify_max_duration=cnf.getint(s, 'verify_max_duration', fallback=600),
+                    verify_period=cnf.getint(s, 'verify_period', fallback=0),
+                    verify_archives_interval=cnf.getint(s, 'verify_archives_interval', fallback=0),
                     restrict_to_environments=cnf.getboolean(s, 'restrict_to_environments', fallback=False),
                     allowed_environments=shlex.split(cnf.get(s, 'allowed_environments', fallback=''))
                 ))
+                if not bbackups[-1].backup_directories and not bbackups[-1].stdin_sources:
+                    raise ValueError('backup \'%s\' has neither backup_directories nor stdin_sources' % (s,))
+                bbackups[-1].check_archive_series()
         return bbackups
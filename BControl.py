@@ -0,0 +1,137 @@
+import argparse
+import json
+import logging
+import socket
+from functools import partial
+
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+
+
+class BControlServer:
+    # Maximum size of a request in bytes, longer ones are rejected
+    max_request_size = 65536
+
+    def __init__(self, path, handler):
+        # handler is called as handler(request, reply) in the main thread, with request being the decoded json
+        # object and reply a function that sends a json response to the client and closes the connection
+        self.path = path
+        self.handler = handler
+        self.buffers = {}
+
+        # Do not take the socket away from another instance that is still running
+        probe = QLocalSocket()
+        probe.connectToServer(path)
+        if probe.waitForConnected(1000):
+            probe.disconnectFromServer()
+            self.server = None
+            logging.error('Control socket \'%s\' is used by another running instance, control commands are '
+                          'disabled.', path)
+            return
+
+        # Nothing answers, so it is a stale socket of a previous instance
+        QLocalServer.removeServer(path)
+
+        self.server = QLocalServer()
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self.new_connection)
+        if self.server.listen(path):
+            logging.info('Listening for control commands on \'%s\'', path)
+        else:
+            logging.error('Could not listen on control socket \'%s\': %s', path, self.server.errorString())
+
+    def new_connection(self):
+        while self.server.hasPendingConnections():
+            conn = self.server.nextPendingConnection()
+            self.buffers[id(conn)] = b''
+            conn.readyRead.connect(partial(self.ready_read, conn))
+            conn.disconnected.connect(partial(self.disconnected, conn))
+
+    def disconnected(self, conn):
+        self.buffers.pop(id(conn), None)
+        conn.deleteLater()
+
+    def ready_read(self, conn):
+        buffer = self.buffers.get(id(conn))
+        if buffer is None:
+            # Only one request per connection, the request of this one is already handled
+            conn.readAll()
+            return
+
+        buffer += bytes(conn.readAll())
+        reply = partial(self.send, conn)
+        if b'\n' not in buffer:
+            if len(buffer) > self.max_request_size:
+                self.buffers[id(conn)] = None
+                reply({'ok': False, 'error': 'Request too large'})
+            else:
+                self.buffers[id(conn)] = buffer
+            return
+
+        self.buffers[id(conn)] = None
+        line = buffer.split(b'\n', 1)[0]
+        try:
+            request = json.loads(line.decode())
+            if not isinstance(request, dict):
+                raise ValueError('request is not an object')
+        except ValueError as e:
+            reply({'ok': False, 'error': 'Invalid request: %s' % (str(e),)})
+        else:
+            logging.debug('Control request: %s', str(request))
+            self.handler(request, reply)
+
+    @staticmethod
+    def send(conn, response):
+        try:
+            if conn.state() != QLocalSocket.ConnectedState:
+                return
+            conn.write(json.dumps(response).encode() + b'\n')
+            conn.flush()
+            conn.disconnectFromServer()
+        except RuntimeError:
+            # Client went away and the connection object is already deleted
+            pass
+
+
+def send_request(path, request):
+    # Send a single request to a running borgBackupTimer and wait for its response
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(request).encode() + b'\n')
+        data = b''
+        while b'\n' not in data:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data.decode())
+
+
+def ctl(argv, path):
+    parser = argparse.ArgumentParser(prog='borgbackuptimer ctl',
+                                     description='Control a running borgBackupTimer. Responses are printed as JSON.')
+    sub = parser.add_subparsers(dest='cmd', metavar='command')
+    sub.required = True
+    sub.add_parser('status', help='show status of all backups and queued requests')
+    for cmd, hlp in (('run', 'run a backup now'), ('list', 'run borg list on a backup')):
+        p = sub.add_parser(cmd, help=hlp)
+        p.add_argument('backup', help='name of the backup section, the prefix "backup_" may be omitted')
+        if cmd == 'run':
+            p.add_argument('--no-wait', dest='wait', action='store_false',
+                           help='return as soon as the request is queued')
+    sub.add_parser('cancel', help='cancel the running borg command and all queued requests')
+    sub.add_parser('reload', help='reload the configuration file')
+    p = sub.add_parser('runs', help='list logged runs, most recent last')
+    p.add_argument('--backup', help='only list runs of this backup')
+    p.add_argument('--limit', type=int, default=20, help='maximum number of runs to list (default: %(default)s)')
+    p = sub.add_parser('log', help='show the log lines of a single run')
+    p.add_argument('run_id', type=int, nargs='?', help='id of the run as shown by "runs", defaults to the last run')
+    args = parser.parse_args(argv)
+
+    request = vars(args)
+    try:
+        response = send_request(path, request)
+    except (OSError, ValueError) as e:
+        response = {'ok': False, 'error': 'Could not talk to borgBackupTimer on \'%s\': %s' % (path, str(e))}
+
+    print(json.dumps(response, indent=2))
+    return 0 if response.get('ok') else 1
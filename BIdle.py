@@ -0,0 +1,130 @@
+import json
+import logging
+import threading
+import time
+
+from funcs import get_load_average, get_user_idle_time, get_network_bytes
+
+
+class BIdleProfile:
+    # Number of profile slots, one for every hour of the week
+    slots = 7 * 24
+
+    # Weight of a new sample in the rolling average of its slot
+    smoothing = 0.2
+
+    # Busyness assumed for slots without any samples yet
+    unknown = 0.5
+
+    # Resolution when searching for the best start time, in seconds
+    step = 900
+
+    # Busyness difference small enough to not be worth waiting for
+    tolerance = 0.05
+
+    # Seconds after a job of borgBackupTimer until the load average does not include it anymore
+    job_settle_time = 300
+
+    def __init__(self, profile_file, net_busy_rate, user_idle_threshold):
+        self.profile_file = profile_file
+        self.net_busy_rate = net_busy_rate
+        self.user_idle_threshold = user_idle_threshold
+        self.profile = [None] * self.slots
+        self.last_net = None
+        self.job_running = False
+        self.job_end = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.profile_file, 'r') as f:
+                profile = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logging.warning('Idle profile \'%s\' is corrupt, starting a new one.', self.profile_file)
+            return
+        if isinstance(profile, list) and len(profile) == self.slots:
+            self.profile = profile
+
+    def save(self):
+        with open(self.profile_file, 'w') as f:
+            json.dump(self.profile, f)
+
+    def slot(self, timestamp):
+        lt = time.localtime(timestamp)
+        return lt.tm_wday * 24 + lt.tm_hour
+
+    def sample(self):
+        # Measure how busy the system is right now (0 is idle, 1 is busy) and add it to the profile
+        now = time.time()
+        net = get_network_bytes()
+        with self.lock:
+            # Load and traffic of our own jobs must not be learned as busyness, or backups avoid their own hours
+            skip = self.job_running or now - self.job_end < self.job_settle_time
+            last_net = self.last_net
+            self.last_net = None if net is None or self.job_running else (now, net)
+        if skip:
+            logging.debug('Skipping idle profile sample, a job of borgBackupTimer ran recently.')
+            return
+
+        components = [min(get_load_average(), 1.0)]
+
+        user_idle = get_user_idle_time()
+        if user_idle is not None:
+            components.append(1.0 if user_idle < self.user_idle_threshold else 0.0)
+
+        if net is not None and last_net is not None and now > last_net[0]:
+            rate = (net - last_net[1]) / (now - last_net[0])
+            components.append(min(max(rate, 0) / self.net_busy_rate, 1.0))
+
+        score = sum(components) / len(components)
+        with self.lock:
+            slot = self.slot(now)
+            old = self.profile[slot]
+            self.profile[slot] = score if old is None else (1 - self.smoothing) * old + self.smoothing * score
+            self.save()
+        logging.debug('Idle profile sample: busyness %.2f from %s', score, str(components))
+
+    def job_started(self):
+        # Called when a job is started, traffic since the last sample includes it
+        with self.lock:
+            self.job_running = True
+            self.last_net = None
+
+    def job_finished(self):
+        with self.lock:
+            if self.job_running:
+                self.job_running = False
+                self.job_end = time.time()
+
+    def expected_busyness(self, start, duration):
+        # Average busyness over a run from start taking duration seconds
+        with self.lock:
+            values = []
+            t = start
+            while True:
+                value = self.profile[self.slot(t)]
+                values.append(self.unknown if value is None else value)
+                t += self.step
+                if t >= start + duration:
+                    break
+        return sum(values) / len(values)
+
+    def is_good_start(self, now, latest_start, duration):
+        # Returns True if no start time until latest_start is expected to be noticeably quieter than now
+        current = self.expected_busyness(now, duration)
+        best, best_start = current, now
+        t = now
+        while t < latest_start:
+            t = min(t + self.step, latest_start)
+            value = self.expected_busyness(t, duration)
+            if value < best:
+                best, best_start = value, t
+
+        if current <= best + self.tolerance:
+            return True
+        logging.info('Expected busyness now is %.2f, waiting for %s with expected busyness %.2f',
+                     current, time.strftime('%Y-%m-%d %H:%M', time.localtime(best_start)), best)
+        return False
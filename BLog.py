@@ -0,0 +1,167 @@
+import json
+import logging.handlers
+import os
+import time
+
+
+class BRunLogHandler(logging.handlers.RotatingFileHandler):
+    # Rotating log file handler that keeps a sidecar index of where each run's lines are stored.
+    # Every run has a list of segments [file_index, start_offset, end_offset], file_index 0 is the current log file,
+    # 1 the first rotated one and so on. end_offset is None while the run is still writing to that file.
+    # Runs that lost segments, e.g. because their oldest file was rotated out, are marked as truncated.
+
+    def __init__(self, filename, maxBytes=0, backupCount=0):
+        super(BRunLogHandler, self).__init__(filename, maxBytes=maxBytes, backupCount=backupCount)
+        self.index_file = self.baseFilename + '.idx'
+        self.index = {'next_id': 1, 'runs': []}
+        self.load_index()
+
+    def log_file(self, file_index):
+        return self.baseFilename if file_index == 0 else '%s.%d' % (self.baseFilename, file_index)
+
+    def file_size(self, file_index):
+        try:
+            return os.path.getsize(self.log_file(file_index))
+        except OSError:
+            return None
+
+    def load_index(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logging.warning('Run log index \'%s\' is corrupt, starting a new one.', self.index_file)
+            return
+
+        # Drop everything that does not match the log files anymore, e.g. after they were removed manually
+        runs = []
+        for run in index.get('runs', []):
+            segments = []
+            for file_index, start, end in run['segments']:
+                size = self.file_size(file_index)
+                if size is None or start > size or (end is not None and end > size):
+                    continue
+                segments.append([file_index, start, end])
+            if not segments:
+                continue
+            if len(segments) < len(run['segments']):
+                run['truncated'] = True
+            if run['end'] is None:
+                # borgBackupTimer was stopped during this run
+                segments[-1][2] = self.file_size(segments[-1][0])
+                run['end'] = int(time.time())
+                run['outcome'] = 'aborted'
+            run['segments'] = segments
+            runs.append(run)
+        self.index = {'next_id': index.get('next_id', 1), 'runs': runs}
+        self.save_index()
+
+    def save_index(self):
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_file)
+
+    def current_offset(self):
+        if self.stream is not None:
+            self.stream.flush()
+        size = self.file_size(0)
+        return 0 if size is None else size
+
+    def begin_run(self, name, kind):
+        # Mark the start of a run, all following lines up to end_run belong to it. Returns the run id.
+        self.acquire()
+        try:
+            run_id = self.index['next_id']
+            self.index['next_id'] += 1
+            self.index['runs'].append({
+                'id': run_id,
+                'name': name,
+                'kind': kind,
+                'start': int(time.time()),
+                'end': None,
+                'outcome': None,
+                'segments': [[0, self.current_offset(), None]]
+            })
+            self.save_index()
+        finally:
+            self.release()
+        return run_id
+
+    def end_run(self, run_id, outcome):
+        self.acquire()
+        try:
+            for run in self.index['runs']:
+                if run['id'] == run_id and run['end'] is None:
+                    run['segments'][-1][2] = self.current_offset()
+                    run['end'] = int(time.time())
+                    run['outcome'] = outcome
+                    self.save_index()
+                    break
+        finally:
+            self.release()
+
+    def doRollover(self):
+        # Called with the handler lock held
+        if self.backupCount <= 0:
+            # Nothing is rotated, the log file just keeps growing
+            super(BRunLogHandler, self).doRollover()
+            return
+
+        open_runs = [run for run in self.index['runs'] if run['end'] is None]
+        for run in open_runs:
+            run['segments'][-1][2] = self.current_offset()
+
+        super(BRunLogHandler, self).doRollover()
+
+        # All files moved up by one, the oldest one is gone
+        runs = []
+        for run in self.index['runs']:
+            segments = [[file_index + 1, start, end] for file_index, start, end in run['segments']
+                        if file_index + 1 <= self.backupCount]
+            if len(segments) < len(run['segments']):
+                # Only the tail of this run is left
+                run['truncated'] = True
+            run['segments'] = segments
+            if run in open_runs:
+                run['segments'].append([0, 0, None])
+            if run['segments']:
+                runs.append(run)
+        self.index['runs'] = runs
+        self.save_index()
+
+    def runs(self):
+        # Summary of all indexed runs, oldest first
+        self.acquire()
+        try:
+            return [{k: v for k, v in run.items() if k != 'segments'} for run in self.index['runs']]
+        finally:
+            self.release()
+
+    def extract(self, run_id):
+        # Lines logged during the given run, None if the run is unknown or not available anymore
+        self.acquire()
+        try:
+            run = next((run for run in self.index['runs'] if run['id'] == run_id), None)
+            if run is None:
+                return None
+            if self.stream is not None:
+                self.stream.flush()
+            data = b''
+            for file_index, start, end in run['segments']:
+                try:
+                    with open(self.log_file(file_index), 'rb') as f:
+                        f.seek(start)
+                        chunk = f.read() if end is None else f.read(end - start)
+                except OSError:
+                    # Log file was removed outside of this handler
+                    return None
+                if end is not None and len(chunk) < end - start:
+                    # Log file was truncated outside of this handler
+                    return None
+                data += chunk
+            return data.decode(errors='replace')
+        finally:
+            self.release()
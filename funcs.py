@@ -1,3 +1,4 @@
+import os
 import subprocess
 import re
 import urllib.request
@@ -50,3 +51,42 @@ def get_global_ip():
         return match.groupdict()['ip']
     else:
         return None
+
+
+def get_load_average():
+    # 1 minute load average per cpu
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def get_user_idle_time():
+    # Seconds since last user input, None if xprintidle is not available
+    try:
+        p = subprocess.Popen(['xprintidle'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        return None
+    try:
+        stdout = p.communicate(timeout=0.8)[0]
+    except subprocess.TimeoutExpired:
+        p.kill()
+        return None
+    try:
+        return int(stdout.decode().strip()) / 1000
+    except ValueError:
+        return None
+
+
+def get_network_bytes():
+    # Total bytes received and transmitted on all interfaces except loopback, None if not available
+    try:
+        with open('/proc/net/dev', 'r') as f:
+            lines = f.read().splitlines()[2:]
+    except OSError:
+        return None
+    total = 0
+    for line in lines:
+        iface, data = line.split(':', 1)
+        if iface.strip() == 'lo':
+            continue
+        fields = data.split()
+        total += int(fields[0]) + int(fields[8])
+    return total
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 import configparser
+import heapq
+import itertools
 import logging
-import logging.handlers
 import os
 import shlex
 import subprocess
 import sys
 import tempfile
+import time
 from collections import deque
 from functools import partial
 
@@ -15,10 +17,29 @@ from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QSystemTrayIcon, QMenu, QAction, QApplication
 
 from BBackup import BBackup
+from BControl import BControlServer, ctl
 from BEnv import BEnv
+from BIdle import BIdleProfile
+from BLog import BRunLogHandler
 from BTask import BTask
 from ParseTerminalCommand import parse_terminal_command
 
+# Priorities of queued actions, lower values are served first
+PRIORITY_USER = 0
+PRIORITY_SCHEDULED = 1
+
+# Names of the values stored in MainApp.status, as reported on the control socket
+STATUS_NAMES = {-1: 'running', 0: 'ok', 1: 'unreachable', 2: 'failed'}
+
+# Types of the fields of control socket requests
+REQUEST_FIELDS = {
+    'cmd': str,
+    'backup': (str, type(None)),
+    'wait': bool,
+    'limit': int,
+    'run_id': (int, type(None))
+}
+
 
 class MainApp:
     def __init__(
@@ -26,10 +47,16 @@ class MainApp:
             qapp,
             bbackups,
             check_interval,
+            max_backups_per_host,
+            resume_retry_interval,
             environments,
+            idle_profile,
             graphical_editor,
             log_path,
-            terminal_command
+            run_log,
+            terminal_command,
+            config_loader,
+            control_socket
     ):
         # Reference to main PyQt.QApplication
         self.qapp = qapp
@@ -40,9 +67,18 @@ class MainApp:
         # Store path to log file
         self.log_path = log_path
 
+        # Log handler keeping an index of where the lines of each run are stored
+        self.run_log = run_log
+
+        # Number of runs shown in the run log menu
+        self.run_log_menu_size = 15
+
         # Save prepared function for terminal command generation
         self.terminal_command = terminal_command
 
+        # Function returning a freshly read config, used to reload the configuration
+        self.config_loader = config_loader
+
         # Load all tray icon files
         self.icon = QIcon("icons/icon.png")
         self.icon_running = [
@@ -68,9 +104,22 @@ class MainApp:
         self.micon_console = QIcon("icons/micon_console.png")
 
         # Keep track of borg backups
+        self.all_bbackups = list(bbackups)
         self.bbackups = deque(bbackups)
         self.bbackups_ = deque()
 
+        # Jobs (bbackup, kind) sharing the host of the current bbackup, run back-to-back in this cycle
+        self.group = deque()
+
+        # Maximum number of bbackups run for one host in a single cycle, 0 means no limit
+        self.max_backups_per_host = max_backups_per_host
+
+        # Seconds after which to try again when an interrupted bbackup could not be resumed
+        self.resume_retry_interval = resume_retry_interval
+
+        # Number of failed host checks in a row per host with interrupted bbackups, the retry delay doubles with each
+        self.resume_retries = {}
+
         # Keep track of stati of borg backups and other commands
         # This dict determines which icon is displayed in tray
         self.status = {}
@@ -78,6 +127,12 @@ class MainApp:
         # Get all environments (BEnv objects)
         self.environments = environments
 
+        # Rolling profile of system busyness, used to start backups in quiet periods
+        self.idle_profile = idle_profile
+
+        # Seconds between two scheduled cycles
+        self.check_interval = check_interval
+
         # Setup tray icon
         self.qapp.setQuitOnLastWindowClosed(False)
         self.tray = QSystemTrayIcon()
@@ -85,6 +140,61 @@ class MainApp:
 
         # Create right-click menu for tray
         self.menu = QMenu()
+        self.build_menu()
+        self.tray.setContextMenu(self.menu)
+
+        # Setup main timer and set interval to config-defined value
+        self.main_timer = QTimer()
+        self.main_timer.setInterval(check_interval * 1000)
+        self.main_timer.timeout.connect(self.timed)
+
+        # Setup timer for retrying interrupted bbackups, restarted whenever a retry is scheduled
+        self.resume_timer = QTimer()
+        self.resume_timer.setSingleShot(True)
+        self.resume_timer.timeout.connect(self.timed)
+
+        # Setup icon update timer with interval of 200ms
+        self.status_timer = QTimer()
+        self.status_timer.setInterval(200)
+        self.status_timer.timeout.connect(self.update_status)
+
+        # Instantiate a thread pool for long running operations later
+        self.thread_pool = QThreadPool()
+
+        # Display tray icon
+        self.tray.setVisible(True)
+
+        # Create status variables
+        self.cur = None
+        self.cur_kind = None
+        self.cur_run = None
+        self.busy = False
+        self.valid_envs = []
+        self.user_mode = False
+
+        # Priority queue of requested actions, served whenever borgBackupTimer is not busy
+        # Entries are tuples (priority, sequence number, action, bbackup, reply)
+        self.pending = []
+        self.pending_seq = itertools.count()
+
+        # Function to send the result of the current action to the control socket client who requested it
+        self.cur_reply = None
+
+        # Serve control commands from the main loop
+        self.control_server = None
+        if control_socket:
+            self.control_server = BControlServer(control_socket, self.handle_request)
+
+        # Trigger normally timer-triggered function first
+        self.timed()
+        # Then start timers
+        self.main_timer.start()
+        self.status_timer.start()
+
+        logging.debug('Setup main qt app, main_timer started with interval of %d seconds.' % (check_interval,))
+
+    def build_menu(self):
+        self.menu.clear()
 
         self.exit_action = QAction("Exit", self.qapp)
         self.exit_action.triggered.connect(self.click_exit)
@@ -94,7 +204,7 @@ class MainApp:
         self.borg_list_actions = {}
         self.borg_create_actions = {}
         self.borg_console_actions = {}
-        for bbackup in self.bbackups:
+        for bbackup in self.all_bbackups:
             self.menu.addSeparator()
             self.borg_list_actions[bbackup.name] = QAction('List "%s"' % bbackup.name, self.qapp)
             self.borg_list_actions[bbackup.name].triggered.connect(partial(self.click_borg_list, bbackup))
@@ -118,54 +228,23 @@ class MainApp:
         self.log_action.setIcon(self.micon_log)
         self.menu.addAction(self.log_action)
 
-        self.tray.setContextMenu(self.menu)
-
-        # Setup main timer and set interval to config-defined value
-        self.main_timer = QTimer()
-        self.main_timer.setInterval(check_interval * 1000)
-        self.main_timer.timeout.connect(self.timed)
-
-        # Setup icon update timer with interval of 200ms
-        self.status_timer = QTimer()
-        self.status_timer.setInterval(200)
-        self.status_timer.timeout.connect(self.update_status)
-
-        # Instantiate a thread pool for long running operations later
-        self.thread_pool = QThreadPool()
-
-        # Display tray icon
-        self.tray.setVisible(True)
-
-        # Create status variables
-        self.cur = None
-        self.busy = False
-        self.valid_envs = []
-        self.user_mode = False
-
-        # Trigger normally timer-triggered function first
-        self.timed()
-        # Then start timers
-        self.main_timer.start()
-        self.status_timer.start()
-
-        logging.debug('Setup main qt app, main_timer started with interval of %d seconds.' % (check_interval,))
+        # Submenu listing the most recent runs, filled when opened
+        self.run_log_menu = self.menu.addMenu(self.micon_log, 'Show log of run')
+        self.run_log_menu.aboutToShow.connect(self.build_run_log_menu)
+
+    def build_run_log_menu(self):
+        self.run_log_menu.clear()
+        runs = self.run_log.runs()[-self.run_log_menu_size:]
+        if not runs:
+            self.run_log_menu.addAction('No runs logged').setEnabled(False)
+        for run in reversed(runs):
+            action = self.run_log_menu.addAction('%s "%s" (%s): %s' % (
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(run['start'])), run['name'], run['kind'],
+                run['outcome'] or 'running') + (' (truncated)' if run.get('truncated') else ''))
+            action.triggered.connect(partial(self.click_run_log, run['id']))
 
     def update_status(self):
-        # Make sure buttons are disabled when borgBackupTimer is busy
-        if self.busy:
-            for a in self.borg_list_actions.values():
-                a.setEnabled(False)
-            for a in self.borg_create_actions.values():
-                a.setEnabled(False)
-            for a in self.borg_console_actions.values():
-                a.setEnabled(False)
-        else:
-            for a in self.borg_list_actions.values():
-                a.setEnabled(True)
-            for a in self.borg_create_actions.values():
-                a.setEnabled(True)
-            for a in self.borg_console_actions.values():
-                a.setEnabled(True)
+        # Buttons stay enabled while borgBackupTimer is busy, requested actions are queued
 
         # Depending on values in status, set icon
         vals = self.status.values()
@@ -188,20 +267,67 @@ class MainApp:
             elif max(vals) > 1:
                 self.tray.setIcon(self.icon_error)
 
+    def enqueue(self, priority, action, bbackup=None, reply=None):
+        # Queue an action, it is started as soon as borgBackupTimer is not busy anymore
+        # A single scheduled cycle catches up on everything that is due, so it is queued only once
+        if action == 'cycle' and any(entry[2] == 'cycle' for entry in self.pending):
+            return None
+        entry = (priority, next(self.pending_seq), action, bbackup, reply)
+        heapq.heappush(self.pending, entry)
+        QTimer.singleShot(0, self.serve_queue)
+        return entry
+
+    def serve_queue(self):
+        if self.busy or not self.pending:
+            return
+
+        _, _, action, bbackup, reply = heapq.heappop(self.pending)
+        self.busy = True
+        self.cur_reply = reply
+        if action == 'cycle':
+            self.start_cycle()
+        elif action == 'create':
+            self.start_user_create(bbackup)
+        elif action == 'list':
+            self.start_user_list(bbackup)
+        elif action == 'reload':
+            self.reload()
+
+    def set_idle(self):
+        # The current action is finished, continue with queued ones
+        self.cur = None
+        self.cur_kind = None
+        self.user_mode = False
+        self.busy = False
+        self.idle_profile.job_finished()
+        QTimer.singleShot(0, self.serve_queue)
+
+    def send_reply(self, response):
+        # Send result of the current action to the control socket client, if it was requested by one
+        if self.cur_reply is not None:
+            self.cur_reply(response)
+            self.cur_reply = None
+
     def timed(self):
         # this function is triggered by the main timer
-        if not self.busy:
-            logging.debug('Main timer triggered.')
-
-            # Run update_env (Long running, therefore started asynchronously)
-            self.busy = True
-            task = BTask(self.update_env)
-            task.signals.done.connect(self.call_env_update_done)
-            task.signals.fail.connect(self.call_env_update_failed)
-            logging.info('Updating valid environments')
-            self.thread_pool.start(task)
+        logging.debug('Main timer triggered.')
+        self.enqueue(PRIORITY_SCHEDULED, 'cycle')
+
+    def start_cycle(self):
+        # Run update_env (Long running, therefore started asynchronously)
+        task = BTask(self.update_env)
+        task.signals.done.connect(self.call_env_update_done)
+        task.signals.fail.connect(self.call_env_update_failed)
+        logging.info('Updating valid environments')
+        self.thread_pool.start(task)
 
     def update_env(self):
+        # Record how busy the system currently is
+        try:
+            self.idle_profile.sample()
+        except Exception as e:
+            logging.warning('Sampling system idleness failed: %s', str(e))
+
         # Check all environments, add them to valid_envs if check() returns true
         try:
             self.valid_envs = [e for e in self.environments.values() if e.check()]
@@ -214,7 +340,7 @@ class MainApp:
     def call_env_update_failed(self):
         logging.error('Valid environments update failed! Setting to [].')
         self.valid_envs = []
-        self.busy = False
+        self.set_idle()
 
     def call_env_update_done(self):
         # Environments are updated now
@@ -224,47 +350,119 @@ class MainApp:
                 item = self.bbackups_.popleft()
                 self.bbackups.append(item)
 
-        # Walk through entries in the queue
+        # Walk through entries in the queue and collect all jobs that need to be run
+        # A job is a tuple (bbackup, kind), kind is 'create' or a verification kind ('repository' or 'archives')
+        due = []
         while self.bbackups:
-            self.cur = self.bbackups.popleft()
+            bbackup = self.bbackups.popleft()
 
             # Does this bbackup need to be run?
-            if self.cur.check():
-                logging.info('Check if \'%s\' needs to be run: YES', self.cur.name)
+            if bbackup.check(self.idle_profile, self.check_interval):
+                logging.info('Check if \'%s\' needs to be run: YES', bbackup.name)
 
                 # Can this backup run in an environment that is currently valid?
-                if self.cur.env_check(self.valid_envs):
-                    logging.info('Check if \'%s\' is allowed to be run in current environment: YES', self.cur.name)
-
-                    # Run connect_check
-                    self.status[self.cur.name] = -1
-                    task = BTask(self.cur.connect_check)
-                    task.signals.done.connect(self.call_host_check_done)
-                    task.signals.fail.connect(self.call_host_check_fail)
-                    self.thread_pool.start(task)
-                    return
+                if bbackup.env_check(self.valid_envs):
+                    logging.info('Check if \'%s\' is allowed to be run in current environment: YES', bbackup.name)
+                    due.append((bbackup, 'create'))
                 else:
-                    self.status[self.cur.name] = 0
-                    logging.info('Check if \'%s\' is allowed to be run in current environment: NO', self.cur.name)
-                    self.bbackups_.append(self.cur)
+                    self.status[bbackup.name] = 0
+                    logging.info('Check if \'%s\' is allowed to be run in current environment: NO', bbackup.name)
+                    self.bbackups_.append(bbackup)
             else:
-                self.status[self.cur.name] = 0
-                logging.info('Check if \'%s\' needs to be run: NO', self.cur.name)
-                self.bbackups_.append(self.cur)
+                self.status[bbackup.name] = 0
+                logging.info('Check if \'%s\' needs to be run: NO', bbackup.name)
+
+                # Does the repository of this bbackup need to be verified?
+                kind = bbackup.verify_due()
+                if kind is not None and bbackup.env_check(self.valid_envs):
+                    logging.info('Check if \'%s\' needs to be verified: YES (%s)', bbackup.name, kind)
+                    due.append((bbackup, kind))
+                else:
+                    self.bbackups_.append(bbackup)
+
+        if not due:
+            # Walked through all bbackups, none was started, so we're done for now
+            self.set_idle()
+            return
+
+        # Group due jobs by host, the first host in queue order is served in this cycle
+        # Interrupted bbackups are resumed first, then backups that cannot wait any longer for a quiet period,
+        # backups are run before verifications
+        due.sort(key=lambda job: (not job[0].resume_pending(),
+                                  not (job[1] == 'create' and job[0].latest_start_reached(self.check_interval)),
+                                  job[1] != 'create'))
+        host = due[0][0].host
+        group = [job for job in due if job[0].host == host]
+        if self.max_backups_per_host > 0:
+            group = group[:self.max_backups_per_host]
+
+        # All other due bbackups stay in the queue and are served in the next main timer cycles
+        for job in due:
+            if job not in group:
+                self.bbackups.append(job[0])
+                if job[1] == 'create' and job[0].latest_start_reached(self.check_interval):
+                    # Waiting for the main timer would miss the latest start, run another cycle right after this one
+                    self.enqueue(PRIORITY_SCHEDULED, 'cycle')
+
+        logging.info('Running %d job(s) for host \'%s\': %s', len(group), host,
+                     str(['%s (%s)' % (bbackup.name, kind) for bbackup, kind in group]))
+        for bbackup, kind in group:
+            bbackup.cancelled = False
+            self.status[self.status_key(bbackup, kind)] = -1
+        self.group = deque(group)
+        self.cur, self.cur_kind = self.group.popleft()
+
+        # Run connect_check once for the whole group
+        self.start_host_check()
+
+    def start_host_check(self):
+        task = BTask(self.cur.connect_check)
+        task.signals.done.connect(self.call_host_check_done)
+        task.signals.fail.connect(self.call_host_check_fail)
+        self.thread_pool.start(task)
 
-        # Walked through all bbackups, none was started, so we're done for now
-        self.busy = False
+    @staticmethod
+    def status_key(bbackup, kind):
+        # Verification results are kept apart, so they stay visible until the next verification
+        return bbackup.name if kind == 'create' else bbackup.name + ':verify'
+
+    def start_backup(self):
+        # Everything logged from here on until the job is finished can be looked up as one run
+        self.cur_run = self.run_log.begin_run(self.cur.name, self.cur_kind)
+        self.idle_profile.job_started()
+        if self.cur_kind == 'create':
+            task = BTask(self.cur.run)
+            task.signals.done.connect(self.call_backup_done)
+            task.signals.fail.connect(self.call_backup_fail)
+            logging.info('Launching borg for \'%s\'...', self.cur.name)
+        else:
+            task = BTask(self.cur.run_verify, self.cur_kind)
+            task.signals.done.connect(self.call_verify_done)
+            task.signals.fail.connect(self.call_verify_fail)
+            logging.info('Launching borg check (%s) for \'%s\'...', self.cur_kind, self.cur.name)
+        self.thread_pool.start(task)
+
+    def end_run(self, outcome):
+        self.run_log.end_run(self.cur_run, outcome)
+        self.cur_run = None
 
     def call_host_check_done(self):
         # current bbackup host is reachable
         logging.debug('Check if backup (\'%s\') host \'%s\' can be reached: YES', self.cur.name, self.cur.host)
+        self.resume_retries.pop(self.cur.host, None)
+
+        if self.cur.cancelled:
+            # The user cancelled while the host was checked
+            logging.warning('Backup (\'%s\') cancelled.', self.cur.name)
+            if not self.user_mode:
+                self.bbackups_.append(self.cur)
+            self.status[self.status_key(self.cur, self.cur_kind)] = 0
+            self.send_reply({'ok': False, 'backup': self.cur.name, 'result': 'cancelled'})
+            self.set_idle()
+            return
 
         # start current bbackup
-        task = BTask(self.cur.run)
-        task.signals.done.connect(self.call_backup_done)
-        task.signals.fail.connect(self.call_backup_fail)
-        logging.info('Launching borg...')
-        self.thread_pool.start(task)
+        self.start_backup()
 
     def call_host_check_fail(self):
         # current bbackup host is not reachable
@@ -272,12 +470,23 @@ class MainApp:
         logging.warning('Aborted backup.')
 
         # We're done with this bbackup for now
-        self.bbackups_.append(self.cur)
-        self.status[self.cur.name] = 1
+        if not self.user_mode:
+            self.bbackups_.append(self.cur)
+        self.status[self.status_key(self.cur, self.cur_kind)] = 1
+
+        # The host is gone, so the remaining jobs of this group cannot be run either
+        while self.group:
+            bbackup, kind = self.group.popleft()
+            logging.warning('Aborted %s of \'%s\', host \'%s\' is not reachable.', kind, bbackup.name, bbackup.host)
+            self.bbackups_.append(bbackup)
+            self.status[self.status_key(bbackup, kind)] = 1
 
         # As we tried this backup, but could not start it, we're done for this main timer cycle
-        self.cur = None
-        self.busy = False
+        if self.cur.resume_pending():
+            self.resume_retries[self.cur.host] = self.resume_retries.get(self.cur.host, 0) + 1
+        self.schedule_resume_retry()
+        self.send_reply({'ok': False, 'backup': self.cur.name, 'result': 'unreachable'})
+        self.set_idle()
 
     def call_backup_done(self):
         # The bbackup completed successfully
@@ -285,63 +494,346 @@ class MainApp:
         if not self.user_mode:
             self.bbackups_.append(self.cur)
         self.status[self.cur.name] = 0
-        self.cur = None
-        self.busy = False
+        self.send_reply({'ok': True, 'backup': self.cur.name, 'result': 'done'})
+        self.end_run('ok')
+        self.next_in_group(host_check=False)
 
     def call_backup_fail(self):
-        # The bbackup failed
-        logging.error('Backup (\'%s\') failed.', self.cur.name)
         if not self.user_mode:
             self.bbackups_.append(self.cur)
-        self.status[self.cur.name] = 2
-        self.cur = None
-        self.busy = False
+        if self.cur.cancelled:
+            # The user cancelled the bbackup
+            logging.warning('Backup (\'%s\') cancelled.', self.cur.name)
+            self.status[self.cur.name] = 0
+            self.send_reply({'ok': False, 'backup': self.cur.name, 'result': 'cancelled'})
+            self.end_run('cancelled')
+        elif self.cur.resume_pending():
+            # The bbackup was interrupted and left checkpoints to resume from
+            logging.warning('Backup (\'%s\') interrupted.', self.cur.name)
+            self.status[self.cur.name] = 1
+            self.send_reply({'ok': False, 'backup': self.cur.name, 'result': 'interrupted'})
+            self.end_run('interrupted')
+            self.schedule_resume_retry()
+        else:
+            # The bbackup failed
+            logging.error('Backup (\'%s\') failed.', self.cur.name)
+            self.status[self.cur.name] = 2
+            self.send_reply({'ok': False, 'backup': self.cur.name, 'result': 'failed'})
+            self.end_run('failed')
+        # The failure may be caused by the host dropping out, check again before the next backup
+        self.next_in_group(host_check=True)
+
+    def call_verify_done(self):
+        # The verification completed without problems
+        logging.info('Verification (%s) of \'%s\' completed successfully.', self.cur_kind, self.cur.name)
+        self.bbackups_.append(self.cur)
+        self.status[self.status_key(self.cur, self.cur_kind)] = 0
+        self.end_run('ok')
+        self.next_in_group(host_check=False)
+
+    def call_verify_fail(self):
+        self.bbackups_.append(self.cur)
+        if self.cur.cancelled:
+            logging.warning('Verification (%s) of \'%s\' cancelled.', self.cur_kind, self.cur.name)
+            self.status[self.status_key(self.cur, self.cur_kind)] = 0
+            self.end_run('cancelled')
+        else:
+            # Problems were found or borg check could not be run
+            logging.error('Verification (%s) of \'%s\' failed.', self.cur_kind, self.cur.name)
+            self.status[self.status_key(self.cur, self.cur_kind)] = 2
+            self.end_run('failed')
+        self.next_in_group(host_check=True)
+
+    def next_in_group(self, host_check):
+        # Continue with the next job on the same host, if any
+        if self.group:
+            self.cur, self.cur_kind = self.group.popleft()
+            if host_check:
+                self.start_host_check()
+            else:
+                # Host was reachable just now, run next backup right away
+                self.start_backup()
+        else:
+            self.set_idle()
+
+    def schedule_resume_retry(self):
+        # Interrupted bbackups should not wait for the main timer to be resumed once the host is back
+        # The delay doubles with every interrupted run and every failed host check in a row
+        retries = [max(b.resume_attempts() - 1, self.resume_retries.get(b.host, 0) - 1, 0)
+                   for b in self.all_bbackups if b.resume_pending()]
+        if self.resume_retry_interval > 0 and retries:
+            delay = min(self.resume_retry_interval * 2 ** min(retries), self.check_interval)
+            logging.info('Retrying interrupted backups in %d seconds.', delay)
+            self.resume_timer.start(delay * 1000)
+
+    def find_request(self, action, bbackup, reply=None):
+        # Look for the same action on bbackup already running or queued, so it is not run twice in a row
+        # If reply is given and no client waits for the found backup yet, reply is attached to it
+        # A list without a client shows its output in an editor, so list requests are never attached
+        # Returns 'running', 'queued' or None and whether reply was attached
+        if reply is not None and action != 'create':
+            reply = None
+        if self.busy and self.cur is bbackup and self.cur_kind == action:
+            if reply is not None and self.cur_reply is None:
+                self.cur_reply = reply
+                return 'running', True
+            return 'running', False
+        if any(b is bbackup and kind == action for b, kind in self.group):
+            # Will be run later in the current cycle
+            return 'running', False
+        for i, (priority, seq, a, b, r) in enumerate(self.pending):
+            if a == action and b is bbackup:
+                if reply is not None and r is None:
+                    # Same priority and sequence number, the heap order is not changed
+                    self.pending[i] = (priority, seq, a, b, reply)
+                    return 'queued', True
+                return 'queued', False
+        return None, False
 
     def click_borg_list(self, bbackup):
-        # The user requested a borg list command on bbackup
-        if not self.busy:
-            self.busy = True
-            self.cur = bbackup
-            self.status['user'] = -1
-            logging.info('User requested list command on \'%s\'', bbackup.name)
-
-            # Run borg list
-            task = BTask(bbackup.run_list)
-            task.signals.done.connect(self.call_list_done)
-            task.signals.fail.connect(self.call_list_done)
-            self.thread_pool.start(task)
-
-    def call_list_done(self):
+        # The user requested a borg list command on bbackup, it is run as soon as borgBackupTimer is not busy
+        logging.info('User requested list command on \'%s\'', bbackup.name)
+        found, _ = self.find_request('list', bbackup)
+        if found is not None:
+            logging.info('List command on \'%s\' is already %s.', bbackup.name, found)
+            return
+        self.enqueue(PRIORITY_USER, 'list', bbackup)
+
+    def start_user_list(self, bbackup):
+        self.cur = bbackup
+        self.cur_kind = 'list'
+        self.cur.cancelled = False
+        self.status['user'] = -1
+        self.idle_profile.job_started()
+        logging.info('Running list command on \'%s\'', bbackup.name)
+
+        # Run borg list
+        task = BTask(bbackup.run_list)
+        task.signals.done.connect(partial(self.call_list_done, True))
+        task.signals.fail.connect(partial(self.call_list_done, False))
+        self.thread_pool.start(task)
+
+    def call_list_done(self, ok):
         # user-requested borg list command completed
-        # now display result in an editor
-        ret = self.cur.list
-        fh, pth = tempfile.mkstemp()
-        with open(pth, 'w') as f:
-            f.write(ret)
-        params = self.graphical_editor + [pth]
-        subprocess.Popen(params, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        self.busy = False
+        if self.cur_reply is not None:
+            # requested on the control socket, send result to the client
+            self.send_reply({'ok': ok, 'backup': self.cur.name, 'output': self.cur.list})
+        else:
+            # now display result in an editor
+            ret = self.cur.list
+            fh, pth = tempfile.mkstemp()
+            with open(pth, 'w') as f:
+                f.write(ret)
+            params = self.graphical_editor + [pth]
+            subprocess.Popen(params, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         self.status['user'] = 0
+        self.set_idle()
 
     def click_log(self):
         # The user requested to see the current log file
         params = self.graphical_editor + [self.log_path]
         subprocess.Popen(params, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
+    def click_run_log(self, run_id):
+        # The user requested to see the log of a single run
+        ret = self.run_log.extract(run_id)
+        if ret is None:
+            logging.warning('Log of run %d is not available anymore.', run_id)
+            return
+        fh, pth = tempfile.mkstemp()
+        with open(pth, 'w') as f:
+            f.write(ret)
+        params = self.graphical_editor + [pth]
+        subprocess.Popen(params, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
     def click_borg_create(self, bbackup):
-        # The user requested to run this bbackup now
-        if not self.busy:
-            self.busy = True
-            self.cur = bbackup
-            self.status[bbackup.name] = -1
-            self.user_mode = True
-            logging.info('User requested to run \'%s\'', bbackup.name)
-
-            # Run host check
-            task = BTask(bbackup.connect_check)
-            task.signals.done.connect(self.call_host_check_done)
-            task.signals.fail.connect(self.call_host_check_fail)
-            self.thread_pool.start(task)
+        # The user requested to run this bbackup now, it is run as soon as borgBackupTimer is not busy
+        logging.info('User requested to run \'%s\'', bbackup.name)
+        found, _ = self.find_request('create', bbackup)
+        if found is not None:
+            logging.info('Backup \'%s\' is already %s.', bbackup.name, found)
+            return
+        self.enqueue(PRIORITY_USER, 'create', bbackup)
+
+    def start_user_create(self, bbackup):
+        self.cur = bbackup
+        self.cur_kind = 'create'
+        self.cur.cancelled = False
+        self.status[bbackup.name] = -1
+        self.user_mode = True
+        logging.info('Running user requested backup \'%s\'', bbackup.name)
+
+        # Run host check
+        self.group = deque()
+        self.start_host_check()
+
+    def find_bbackup(self, name):
+        # The prefix 'backup_' of the section name may be omitted
+        for bbackup in self.all_bbackups:
+            if bbackup.name in (name, 'backup_' + name):
+                return bbackup
+        return None
+
+    def handle_request(self, request, reply):
+        # A command was received on the control socket
+        # Requests may come from any client, so check all fields before using them
+        for key, types in REQUEST_FIELDS.items():
+            if key not in request:
+                continue
+            value = request[key]
+            # bool is a subclass of int, but never a valid number
+            if not isinstance(value, types) or (isinstance(value, bool) and types is not bool):
+                reply({'ok': False, 'error': 'Invalid value for \'%s\'' % (key,)})
+                return
+
+        cmd = request.get('cmd')
+        if cmd == 'status':
+            reply(self.get_status())
+        elif cmd in ('run', 'list'):
+            bbackup = self.find_bbackup(request.get('backup') or '')
+            if bbackup is None:
+                reply({'ok': False, 'error': 'Unknown backup \'%s\'' % (request.get('backup'),)})
+                return
+            logging.info('Control socket requested %s of \'%s\'', cmd, bbackup.name)
+            action = 'create' if cmd == 'run' else 'list'
+            wait = cmd != 'run' or request.get('wait', True)
+            found, attached = self.find_request(action, bbackup, reply if wait else None)
+            if attached:
+                # Reply is sent when the running or queued action is completed
+                return
+            if found is not None:
+                reply({'ok': True, 'backup': bbackup.name, 'result': 'already ' + found})
+            elif not wait:
+                entry = self.enqueue(PRIORITY_USER, action, bbackup)
+                reply({'ok': True, 'backup': bbackup.name, 'result': 'queued',
+                       'position': sorted(self.pending).index(entry) + 1})
+            else:
+                # Reply is sent when the action is completed
+                self.enqueue(PRIORITY_USER, action, bbackup, reply)
+        elif cmd == 'cancel':
+            logging.info('Control socket requested cancel.')
+            reply(self.cancel())
+        elif cmd == 'runs':
+            runs = self.run_log.runs()
+            if request.get('backup'):
+                bbackup = self.find_bbackup(request['backup'])
+                name = bbackup.name if bbackup is not None else request['backup']
+                runs = [run for run in runs if run['name'] == name]
+            limit = request.get('limit', 20)
+            if limit < 1:
+                reply({'ok': False, 'error': 'limit must be a positive number'})
+                return
+            reply({'ok': True, 'runs': runs[-limit:]})
+        elif cmd == 'log':
+            runs = self.run_log.runs()
+            run_id = request.get('run_id')
+            if run_id is None and runs:
+                # Most recent run by default
+                run_id = runs[-1]['id']
+            run = next((run for run in runs if run['id'] == run_id), None)
+            ret = self.run_log.extract(run_id) if run is not None else None
+            if ret is None:
+                reply({'ok': False, 'error': 'Log of run %s is not available' % (run_id,)})
+            else:
+                reply({'ok': True, 'run': run, 'log': ret})
+        elif cmd == 'reload':
+            logging.info('Control socket requested reload.')
+            self.enqueue(PRIORITY_USER, 'reload', reply=reply)
+        else:
+            reply({'ok': False, 'error': 'Unknown command \'%s\'' % (cmd,)})
+
+    def get_status(self):
+        return {
+            'ok': True,
+            'busy': self.busy,
+            'current': self.cur.name if self.cur is not None else None,
+            'queue': [
+                {
+                    'action': action,
+                    'backup': bbackup.name if bbackup is not None else None,
+                    'priority': 'user' if priority == PRIORITY_USER else 'scheduled'
+                }
+                for priority, _, action, bbackup, _ in sorted(self.pending)
+            ],
+            'backups': {
+                bbackup.name: {
+                    'status': STATUS_NAMES.get(self.status.get(bbackup.name)),
+                    'last_backup': bbackup.get_timestamp(),
+                    'resume_pending': bbackup.resume_pending(),
+                    'verify_status': STATUS_NAMES.get(self.status.get(self.status_key(bbackup, 'verify'))),
+                    'verify': bbackup.verify_status()
+                }
+                for bbackup in self.all_bbackups
+            }
+        }
+
+    def cancel(self):
+        # Drop all queued actions and stop the running one
+        cancelled = []
+        for _, _, action, bbackup, reply in sorted(self.pending):
+            cancelled.append({'action': action, 'backup': bbackup.name if bbackup is not None else None})
+            if reply is not None:
+                reply({'ok': False, 'backup': bbackup.name if bbackup is not None else None, 'result': 'cancelled'})
+        self.pending = []
+
+        # Remaining jobs of the current group are tried again in the next cycle
+        while self.group:
+            bbackup, kind = self.group.popleft()
+            self.bbackups_.append(bbackup)
+            self.status[self.status_key(bbackup, kind)] = 0
+
+        running = None
+        if self.cur is not None:
+            running = self.cur.name
+            self.cur.cancel()
+
+        logging.warning('Cancelled %d queued action(s), running: %s', len(cancelled), str(running))
+        return {'ok': True, 'running': running, 'cancelled': cancelled}
+
+    def reload(self):
+        # Re-read config and replace all bbackups and environments
+        logging.info('Reloading configuration.')
+        try:
+            cnf = self.config_loader()
+            bbackups = BBackup.from_config(cnf)
+            environments = BEnv.from_config(cnf)
+            check_interval = cnf.getint('main', 'check_interval', fallback=500)
+            max_backups_per_host = cnf.getint('main', 'max_backups_per_host', fallback=0)
+            resume_retry_interval = cnf.getint('main', 'resume_retry_interval', fallback=60)
+        except (configparser.Error, ValueError) as e:
+            logging.error('Reloading configuration failed: %s', str(e))
+            self.send_reply({'ok': False, 'error': 'Reloading configuration failed: %s' % (str(e),)})
+            self.set_idle()
+            return
+
+        # Queued actions refer to the old bbackup objects, replace them by name
+        by_name = {b.name: b for b in bbackups}
+        pending = []
+        for priority, seq, action, bbackup, reply in self.pending:
+            if bbackup is not None:
+                if bbackup.name not in by_name:
+                    if reply is not None:
+                        reply({'ok': False, 'backup': bbackup.name, 'result': 'removed'})
+                    continue
+                bbackup = by_name[bbackup.name]
+            pending.append((priority, seq, action, bbackup, reply))
+        heapq.heapify(pending)
+        self.pending = pending
+
+        self.all_bbackups = bbackups
+        self.bbackups = deque(bbackups)
+        self.bbackups_ = deque()
+        self.environments = environments
+        self.max_backups_per_host = max_backups_per_host
+        self.resume_retry_interval = resume_retry_interval
+        self.check_interval = check_interval
+        self.main_timer.setInterval(check_interval * 1000)
+        self.status = {k: v for k, v in self.status.items() if k.split(':')[0] in by_name or k == 'user'}
+        self.build_menu()
+
+        logging.info('Reloaded configuration with %d backup(s).', len(bbackups))
+        self.send_reply({'ok': True, 'backups': [b.name for b in bbackups]})
+        self.set_idle()
 
     def click_borg_console(self, bbackup):
         env_cmds = r'echo -e "\033]2;%s console\007"' % bbackup.name + "; "
@@ -367,13 +859,29 @@ class MainApp:
         exit()
 
 
-def main():
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-
+def load_config(script_dir):
     # Setup config parser
     cnf = configparser.ConfigParser()
     cnf._interpolation = configparser.ExtendedInterpolation()
     cnf.read(os.path.join(script_dir, 'config.ini'))
+    return cnf
+
+
+def main():
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+
+    cnf = load_config(script_dir)
+
+    control_socket = cnf.get('main', 'control_socket', fallback='borgBackupTimer.sock')
+    if control_socket:
+        control_socket = os.path.join(script_dir, control_socket)
+
+    # "main.py ctl ..." controls an already running instance
+    if len(sys.argv) > 1 and sys.argv[1] == 'ctl':
+        if not control_socket:
+            print('Control socket is disabled in config.', file=sys.stderr)
+            exit(255)
+        sys.exit(ctl(sys.argv[2:], control_socket))
 
     # Setup logging
     log_formatter = logging.Formatter("%(asctime)s [%(levelname)8.8s] %(message)s", datefmt="%Y-%m-%d %H-%M-%S")
@@ -382,11 +890,9 @@ def main():
     log_path = cnf.get('logging', 'log_dir', fallback='.')
     log_path = os.path.join(script_dir, log_path, cnf.get('logging', 'log_file', fallback='BorgBackupTimer.log'))
 
-    file_handler = logging.handlers.RotatingFileHandler(log_path,
-                                                        maxBytes=cnf.getint('logging', 'log_max_bytes',
-                                                                            fallback=524288),
-                                                        backupCount=cnf.getint('logging', 'log_backup_count',
-                                                                               fallback=3))
+    file_handler = BRunLogHandler(log_path,
+                                  maxBytes=cnf.getint('logging', 'log_max_bytes', fallback=524288),
+                                  backupCount=cnf.getint('logging', 'log_backup_count', fallback=3))
     file_handler.setFormatter(log_formatter)
     root_logger.addHandler(file_handler)
 
@@ -427,11 +933,22 @@ def main():
     # Setup MainApp and read config values
     MainApp(qapp=qapp,
             check_interval=cnf.getint('main', 'check_interval', fallback=500),
+            max_backups_per_host=cnf.getint('main', 'max_backups_per_host', fallback=0),
+            resume_retry_interval=cnf.getint('main', 'resume_retry_interval', fallback=60),
             bbackups=bbackups,
             environments=BEnv.from_config(cnf),
+            idle_profile=BIdleProfile(
+                profile_file=os.path.join(script_dir, cnf.get('main', 'idle_profile_file',
+                                                              fallback='idle_profile.json')),
+                net_busy_rate=cnf.getint('main', 'idle_net_busy_rate', fallback=1048576),
+                user_idle_threshold=cnf.getint('main', 'idle_user_threshold', fallback=300)
+            ),
             graphical_editor=shlex.split(cnf.get('main', 'graphical_editor', fallback='gedit')),
             log_path=log_path,
-            terminal_command=terminal_command)
+            run_log=file_handler,
+            terminal_command=terminal_command,
+            config_loader=partial(load_config, script_dir),
+            control_socket=control_socket)
 
     # Run event loop
     sys.exit(qapp.exec_())